@@ -1,159 +1,474 @@
 #!/usr/bin/env python3
-import abc
+import atexit
+from functools import cached_property
+import hashlib
 import os
 import re
-from subprocess import check_call, check_output, CalledProcessError, STDOUT
+from subprocess import CalledProcessError, DEVNULL, Popen, PIPE, run
 import sys
-import tempfile
-from urllib.parse import quote, urlparse
 
 
-class Repo(metaclass=abc.ABCMeta):
+def _run(cmd, cwd=None):
+    '''Run `cmd` and return its decoded stdout, like `check_output`.'''
+    p = run(cmd, cwd=cwd, capture_output=True, encoding='utf-8', check=True)
+    return p.stdout.rstrip('\n')
 
-    COMMIT_RE = re.compile(r'[a-f0-9]{7,}')
 
-    def __init__(self, what):
+def _succeeds(cmd, cwd=None):
+    '''Run `cmd` discarding its output and tell whether it succeeded.'''
+    try:
+        p = Popen(cmd, cwd=cwd, stdout=DEVNULL, stderr=DEVNULL)
+    except FileNotFoundError:
+        return False
+    return p.wait() == 0
+
+
+def _is_gitfile(path):
+    '''Tell whether `path` is a "gitdir: <path>" file.
+
+    Worktrees and submodules use these instead of a `.git` directory.
+    '''
+    try:
+        with open(path) as f:
+            return f.readline().startswith('gitdir:')
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def _find_repo_root(start):
+    '''Walk up from `start` looking for a `.git` or `.hg` entry.
+
+    Return the repository root and its kind ('git' or 'hg'), or
+    `(None, None)` if no repository is found.
+    '''
+    d = os.path.abspath(start)
+    while True:
+        git = os.path.join(d, '.git')
+        if os.path.isdir(git) or _is_gitfile(git):
+            return d, 'git'
+        if os.path.isdir(os.path.join(d, '.hg')):
+            return d, 'hg'
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None, None
+        d = parent
+
+
+def _find_git_dir(toplevel):
+    '''Return the git directory of the work tree at `toplevel`.'''
+    git_dir = os.path.join(toplevel, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules use a "gitdir: <path>" file
+        with open(git_dir) as f:
+            path = f.read().split(':', 1)[1].strip()
+        git_dir = os.path.join(toplevel, path)
+    return git_dir
+
+
+def _find_common_dir(git_dir):
+    '''Return the directory holding config and refs for `git_dir`.'''
+    # Linked worktrees share them with the main repository
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir):
+        with open(commondir) as f:
+            return os.path.join(git_dir, f.read().strip())
+    return git_dir
+
+
+def _read_ref(common_dir, ref):
+    '''Return the commit `ref` points to, or None if it does not exist.'''
+    try:
+        with open(os.path.join(common_dir, ref)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as f:
+            for line in f:
+                sha, _, name = line.rstrip('\n').partition(' ')
+                if name == ref:
+                    return sha
+    except OSError:
+        pass
+    return None
+
+
+def _global_git_configs():
+    '''Return the user and system git config files.'''
+    xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return [
+        os.environ.get('GIT_CONFIG_GLOBAL') or os.path.expanduser('~/.gitconfig'),
+        os.path.join(xdg, 'git', 'config'),
+        os.environ.get('GIT_CONFIG_SYSTEM') or '/etc/gitconfig',
+    ]
+
+
+def _config_text(path):
+    '''Return the lowercased text of the git config at `path`, if any.'''
+    try:
+        with open(path) as f:
+            return f.read().lower()
+    except OSError:
+        return ''
+
+
+def _has_includes(path):
+    '''Tell whether the git config at `path` pulls in other files.'''
+    return '[include' in _config_text(path)
+
+
+def _rewrites_urls(path):
+    '''Tell whether the git config at `path` may change remote URLs.'''
+    text = _config_text(path)
+    # Included files may hold `url.<base>.insteadOf` rules too
+    return 'insteadof' in text or '[include' in text
+
+
+def _read_config(path):
+    '''Parse an INI-style config file, like `.git/config` or `.hg/hgrc`.'''
+    import configparser
+    # Only '=' separates keys from values, hg paths like `default:pushurl`
+    # contain colons
+    cp = configparser.ConfigParser(
+        delimiters=('=',), strict=False, allow_no_value=True,
+        interpolation=None)
+    try:
+        with open(path) as f:
+            cp.read_file(f)
+    except configparser.Error as e:
+        raise ValueError('Cannot parse {}: {}'.format(path, e)) from e
+    return cp
+
+
+class _CmdServer:
+    '''A long-running process answering one line per query line.
+
+    Used to talk to `git cat-file --batch-check` without spawning a new
+    process for every lookup.
+    '''
+
+    def __init__(self, cmd, cwd=None):
+        self._proc = Popen(
+            cmd, cwd=cwd, stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+            encoding='utf-8', bufsize=1)
+        atexit.register(self.terminate)
+
+    def query(self, spec):
+        self._proc.stdin.write(spec + '\n')
+        self._proc.stdin.flush()
+        return self._proc.stdout.readline().rstrip('\n')
+
+    def terminate(self):
+        if self._proc.poll() is None:
+            # EOF on stdin makes the server exit cleanly
+            self._proc.stdin.close()
+            self._proc.wait()
+
+
+# One `git cat-file` server per repository toplevel
+_CAT_FILE_SERVERS = {}
+
+
+def _cat_file(toplevel):
+    server = _CAT_FILE_SERVERS.get(toplevel)
+    if server is None:
+        server = _CmdServer(
+            ['git', 'cat-file', '--batch-check=%(objecttype)'], cwd=toplevel)
+        _CAT_FILE_SERVERS[toplevel] = server
+    return server
+
+
+def _absolute(what):
+    '''Return `what` as an absolute path, unless it is a bare commit hash.'''
+    if not os.path.exists(what) and Repo.COMMIT_RE.fullmatch(what):
+        return what
+    # Paths are relative to the caller, not to the repo
+    return os.path.abspath(what)
+
+
+def _target_dir(what):
+    '''Return the directory to look for a repository in for `what`.'''
+    if not os.path.exists(what) and Repo.COMMIT_RE.fullmatch(what):
+        # A bare commit hash, resolve it against the current repo
+        return '.'
+    if os.path.isdir(what):
+        return what
+    return os.path.dirname(what) or '.'
+
+
+class Repo:
+
+    COMMIT_RE = re.compile(r'[a-f0-9]{7,40}')
+
+    def __init__(self, what, cwd, toplevel=None):
         self.what = what
-        self.resolver = Resolver.get(self)
+        self._toplevel = toplevel
+        # Where to run git/hg from
+        self._cwd = toplevel or cwd
 
     @staticmethod
-    def get(what):
-        if os.path.isdir(what):
-            what_dir = what
-        else:
-            what_dir = os.path.dirname(what) or '.'
+    def get(what, found=None):
+        '''Return the repo for `what`.
 
-        os.chdir(what_dir)
+        `found` is the result of `_find_repo_root` for `what`, if the
+        caller already walked the tree.
+        '''
+        what_dir = _target_dir(what)
+        if found is None:
+            found = _find_repo_root(what_dir)
+        toplevel, kind = found
+        what = _absolute(what)
 
-        if Git.is_repo():
-            return Git(what)
+        if kind == 'git':
+            return Git(what, what_dir, toplevel=toplevel)
 
-        if Hg.is_repo():
-            return Hg(what)
+        if kind == 'hg':
+            return Hg(what, what_dir, toplevel=toplevel)
+
+        # Nothing found on disk, ask the tools
+        if Git.is_repo(what_dir):
+            return Git(what, what_dir)
+
+        if Hg.is_repo(what_dir):
+            return Hg(what, what_dir)
 
         raise ValueError('Unknown repo: {}'.format(what))
 
     @property
-    @abc.abstractmethod
     def origin(self):
-        return None
+        raise NotImplementedError
 
     @staticmethod
-    @abc.abstractmethod
-    def is_repo():
-        return False
+    def is_repo(cwd):
+        raise NotImplementedError
 
     @property
-    @abc.abstractmethod
     def toplevel(self):
-        return None
+        raise NotImplementedError
 
     @property
-    @abc.abstractmethod
     def branch(self):
-        return None
+        raise NotImplementedError
 
     def is_commit(self, what):
-        return self.COMMIT_RE.match(what) is not None
+        # Cheap checks first, most inputs are paths
+        if not 7 <= len(what) <= 40 or what[0] not in '0123456789abcdef':
+            return False
+        return self.COMMIT_RE.fullmatch(what) is not None
+
+    @cached_property
+    def _toplevel_len(self):
+        return len(self.toplevel)
 
     def relpath(self, what):
         if what.startswith(self.toplevel):
-            what = what[len(self.toplevel):]
+            what = what[self._toplevel_len:]
         what = what.lstrip('/')
         if what == '.':
             what = ''
         return what
 
+    @cached_property
+    def resolver(self):
+        return Resolver.get(self)
+
     def resolve(self):
         return self.resolver.resolve(self.what)
 
 
 class Git(Repo):
 
-    ORIGIN_RE = re.compile(r'^origin(.*)\(fetch\)$')
+    def _git(self, args):
+        return _run(['git'] + args, cwd=self._cwd)
 
     @staticmethod
-    def _git(cmd):
-        output = check_output(['git'] + cmd.split(), stderr=STDOUT)
-        return output.decode('utf-8').strip()
+    def is_repo(cwd):
+        # Fails outside of a work tree, including inside `.git`
+        return _succeeds(['git', 'rev-parse', '--show-toplevel'], cwd=cwd)
 
-    @staticmethod
-    def is_repo():
+    def is_commit(self, what):
+        if not super().is_commit(what):
+            return False
         try:
-            Git._git('status')
+            answer = _cat_file(self.toplevel).query(what)
+        except OSError:
             return True
-        except (CalledProcessError, FileNotFoundError):
-            return False
-
-    @property
-    def toplevel(self):
-        return self._git('rev-parse --show-toplevel')
-
-    @property
-    def branch(self):
+        if answer in ('blob', 'tree'):
+            # Not a file of the work tree either, or `what` would be a path
+            raise ValueError('{} is a {}, not a commit'.format(what, answer))
+        # A commit or a tag. If the answer is missing or ambiguous it may be a
+        # commit that was not fetched yet, and if empty git died: trust the
+        # hash either way
+        return True
+
+    @cached_property
+    def _rev_parse(self):
+        '''Fetch toplevel and branch with a single `git rev-parse`.'''
         try:
             # Try to get the remote branch first
-            remote = self._git('rev-parse --abbrev-ref @{u}')
+            output = self._git(
+                ['rev-parse', '--show-toplevel', '--abbrev-ref', '@{u}'])
+            toplevel, remote = output.splitlines()
             if remote.startswith('remotes/'):
                 remote = remote[len('remotes/'):]
-            return remote.split('/', 1)[-1]
+            branch = remote.split('/', 1)[-1]
         except Exception:
             # Fall back to the local branch name, although this is
             # pretty useless
-            return self._git('rev-parse --abbrev-ref @')
+            output = self._git(
+                ['rev-parse', '--show-toplevel', '--abbrev-ref', '@'])
+            toplevel, branch = output.splitlines()
+        return toplevel, branch
 
-    @property
+    @cached_property
+    def toplevel(self):
+        if self._toplevel is not None:
+            return self._toplevel
+        return self._rev_parse[0]
+
+    def _head_branch(self):
+        '''Read the branch from HEAD, preferring its upstream.
+
+        Return None if HEAD does not point to a local branch.
+        '''
+        with open(os.path.join(self._git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            # Detached HEAD, use the commit
+            return head
+        if not head.startswith('ref: refs/heads/'):
+            return None
+        branch = head[len('ref: refs/heads/'):]
+        section = 'branch "{}"'.format(branch)
+        merge = self._config.get(section, 'merge', fallback=None)
+        if merge and '\n' in merge:
+            return None
+        if merge and merge.startswith('refs/heads/'):
+            return merge[len('refs/heads/'):]
+        # Fall back to the local branch name, although this is
+        # pretty useless
+        return branch
+
+    @cached_property
+    def branch(self):
+        try:
+            branch = self._head_branch()
+        except (OSError, IndexError, ValueError):
+            # Unusual layout, let git figure it out
+            branch = None
+        if branch is not None:
+            return branch
+        return self._rev_parse[1]
+
+    @cached_property
+    def _git_dir(self):
+        return _find_git_dir(self.toplevel)
+
+    @cached_property
+    def _config_path(self):
+        return os.path.join(_find_common_dir(self._git_dir), 'config')
+
+    @cached_property
+    def _config(self):
+        return _read_config(self._config_path)
+
+    def _config_origin(self):
+        '''Return the origin URL as written in `.git/config`.
+
+        Return None if git would report something else, because of quoting,
+        comments, includes or `insteadOf` rules, or if configparser folded
+        an indented line into the value.
+        '''
+        url = self._config['remote "origin"']['url']
+        if any(c in url for c in '"\\;#\n'):
+            return None
+        configs = [self._config_path] + _global_git_configs()
+        if any(_rewrites_urls(path) for path in configs):
+            return None
+        return url
+
+    def _remote_origin(self):
+        from urllib.parse import urlparse
+        try:
+            return urlparse(self._git(['remote', 'get-url', 'origin']))
+        except CalledProcessError:
+            raise ValueError('Origin not found')
+
+    @cached_property
     def origin(self):
-        output = self._git('remote -v')
-        for line in output.splitlines():
-            m = self.ORIGIN_RE.match(line)
-            if m is not None:
-                path = m.groups()[0].strip()
-                return urlparse(path)
-        raise ValueError('Origin not found')
+        from urllib.parse import urlparse
+        try:
+            url = self._config_origin()
+        except (OSError, IndexError, KeyError, ValueError):
+            # Unusual layout
+            url = None
+        if url is None:
+            # Let git figure it out
+            return self._remote_origin()
+        return urlparse(url)
+
+    @cached_property
+    def resolver(self):
+        try:
+            return Resolver.get(self)
+        except ValueError:
+            # The URL read from the config may still need rewriting by git
+            origin = self._remote_origin()
+            if origin == self.origin:
+                raise
+            self.origin = origin
+            return Resolver.get(self)
 
 
 class Hg(Repo):
 
-    ORIGIN_RE = re.compile(r'^default = (.*)$')
-
-    @staticmethod
-    def _hg(cmd):
-        output = check_output(['hg'] + cmd.split(), stderr=STDOUT)
-        return output.decode('utf-8').strip()
+    def _hg(self, args):
+        return _run(['hg'] + args, cwd=self._cwd)
 
     @staticmethod
-    def is_repo():
-        try:
-            Hg._hg('status')
-            return True
-        except (CalledProcessError, FileNotFoundError):
-            return False
+    def is_repo(cwd):
+        return _succeeds(['hg', 'root'], cwd=cwd)
 
-    @property
+    @cached_property
     def origin(self):
-        output = self._hg('paths')
-        for line in output.splitlines():
-            m = self.ORIGIN_RE.match(line)
-            if m is not None:
-                path = m.groups()[0].strip()
-                return urlparse(path)
-        raise ValueError('Origin not found')
+        from urllib.parse import urlparse
+        try:
+            hgrc = os.path.join(self.toplevel, '.hg', 'hgrc')
+            default = _read_config(hgrc)['paths']['default']
+            if '\n' not in default:
+                return urlparse(default)
+        except (OSError, KeyError, ValueError):
+            # Unusual layout, let hg figure it out
+            pass
+        try:
+            return urlparse(self._hg(['paths', 'default']))
+        except CalledProcessError:
+            raise ValueError('Origin not found')
 
-    @property
+    @cached_property
     def toplevel(self):
-        return self._hg('root')
-
-    @property
+        if self._toplevel is not None:
+            return self._toplevel
+        return self._hg(['root'])
+
+    @cached_property
+    def _summary(self):
+        '''Fetch branch and changeset with a single `hg log`.'''
+        output = self._hg(
+            ['log', '-r', '.', '--template', '{branch}\n{node|short}'])
+        branch, changeset = output.splitlines()
+        return branch, changeset
+
+    @cached_property
     def branch(self):
-        return self._hg('branch')
+        return self._summary[0]
 
-    @property
+    @cached_property
     def changeset(self):
-        return self._hg('id')
+        return self._summary[1]
 
 
-class Resolver(metaclass=abc.ABCMeta):
+class Resolver:
 
     LINE_SEP = True
 
@@ -161,24 +476,28 @@ class Resolver(metaclass=abc.ABCMeta):
         self._repo = repo
 
     @staticmethod
-    @abc.abstractmethod
     def can_resolve(origin):
-        return False
+        raise NotImplementedError
 
-    @abc.abstractmethod
     def resolve(self, what):
-        pass
+        raise NotImplementedError
+
+    @cached_property
+    def _url_prefix(self):
+        return self.URL_FMT.format(
+            hostname=self.HOSTNAME, user=self.user, repo=self.repo)
 
     @staticmethod
     def get(repo):
         origin = repo.origin
-        for cls in [
-                GitHub, BitBucket,
-                Kiln, YGGitLab,
-                RocheBitBucket,
-                RocheGitLab,
-                RocheTFS,
-        ]:
+        cls = _RESOLVERS_BY_SCHEME.get(origin.scheme)
+        if cls is None:
+            cls = _RESOLVERS_BY_HOST.get(origin.hostname)
+        if cls is not None:
+            return cls(repo)
+
+        # scp-like origins and subdomains, e.g. git@github.com:user/repo
+        for cls in _RESOLVERS:
             if cls.can_resolve(origin):
                 return cls(repo)
 
@@ -209,8 +528,8 @@ class GitResolver(Resolver):
         return False
 
     def resolve(self, what):
-        url = self.URL_FMT.format(
-            hostname=self.HOSTNAME, user=self.user, repo=self.repo)
+        from urllib.parse import quote
+        url = self._url_prefix
         p, is_commit = self.get_path(what)
         if is_commit:
             url += self.COMMIT_FMT.format(commit=p)
@@ -218,7 +537,7 @@ class GitResolver(Resolver):
             url += self.BLOB_FMT.format(branch=self._repo.branch, path=quote(p))
         return url
 
-    @property
+    @cached_property
     def repo_path(self):
         origin = self._repo.origin.path
         if origin.endswith('.git'):
@@ -227,29 +546,26 @@ class GitResolver(Resolver):
             origin = origin.split(':', 1)[-1]
         return origin
 
-    @property
+    @cached_property
+    def _user_repo(self):
+        # The repo may contain slashes, e.g. GitLab subgroups
+        return self.repo_path.strip('/').split('/', 1)
+
+    @cached_property
     def user(self):
-        return self.repo_path.strip('/').split('/')[0]
+        return self._user_repo[0]
 
-    @property
+    @cached_property
     def repo(self):
-        return self.repo_path.strip('/').split('/', 1)[1]
+        return self._user_repo[1]
 
     def _adjust_lines(self, p):
-        if ':' in p:
-            idx = p.index(':')
-            if self.LINE_SEP:
-                p = ''.join([
-                    p[:idx],
-                    p[idx:].replace(
-                        ':', self.LINE_SEP_FROM
-                    ).replace(
-                        ',', self.LINE_SEP_TO
-                    )
-                ])
-            else:
-                p = p[:idx]
-        return p
+        head, sep, tail = p.partition(':')
+        if not sep:
+            return p
+        if not self.LINE_SEP:
+            return head
+        return head + self.LINE_SEP_FROM + tail.replace(',', self.LINE_SEP_TO)
 
     def get_path(self, what):
         if self._repo.is_commit(what):
@@ -296,17 +612,21 @@ class BitResolver(Resolver):
 
         return False
 
-    @property
+    @cached_property
     def repo_path(self):
         return self._repo.origin.path
 
-    @property
+    @cached_property
+    def _user_repo(self):
+        return self.repo_path.strip('/').split('/', 2)
+
+    @cached_property
     def user(self):
-        return self.repo_path.strip('/').split('/')[0]
+        return self._user_repo[0]
 
-    @property
+    @cached_property
     def repo(self):
-        git_repo = self.repo_path.strip('/').split('/')[1]
+        git_repo = self._user_repo[1]
         if git_repo.endswith('.git'):
             git_repo = git_repo[:-4]
         return git_repo
@@ -329,8 +649,7 @@ class BitBucket(BitResolver):
     COMMIT_FMT = '/commits/{commit}'
 
     def resolve(self, what):
-        url = self.URL_FMT.format(
-            hostname=self.HOSTNAME, user=self.user, repo=self.repo)
+        url = self._url_prefix
         (p, lines), is_commit = self.get_path(what)
         if is_commit:
             url += self.COMMIT_FMT.format(commit=p)
@@ -342,12 +661,11 @@ class BitBucket(BitResolver):
 
     @staticmethod
     def _split_lines(p):
-        if ':' in p:
-            idx = p.index(':')
-            fname = os.path.basename(p[:idx])
-            return p[:idx], p[idx:].replace(
-                ':', '#' + fname + '-').replace(',', ':')
-        return p, ''
+        head, sep, tail = p.partition(':')
+        if not sep:
+            return p, ''
+        fname = os.path.basename(head)
+        return head, '#' + fname + '-' + tail.replace(',', ':')
 
 
 class RocheBitBucket(BitResolver):
@@ -356,10 +674,15 @@ class RocheBitBucket(BitResolver):
     BLOB_FMT = '/browse/{path}?at={branch}'
     COMMIT_FMT = '/commits/{commit}'
 
-    def resolve(self, what):
-        url = self.URL_FMT.format(
+    @cached_property
+    def _url_prefix(self):
+        return self.URL_FMT.format(
             hostname=self.HOSTNAME, user=self.user, repo=self.repo,
             repo_type=self.repo_type)
+
+    def resolve(self, what):
+        from urllib.parse import quote
+        url = self._url_prefix
         (p, lines), is_commit = self.get_path(what)
         if is_commit:
             url += self.COMMIT_FMT.format(commit=p)
@@ -368,11 +691,11 @@ class RocheBitBucket(BitResolver):
                 branch=self._repo.branch, path=quote(p))
         return url + lines
 
-    @property
+    @cached_property
     def user(self):
         return self.repo_path.strip('/').strip('~').split('/')[0]
 
-    @property
+    @cached_property
     def repo_type(self):
         path = self.repo_path.strip('/')
         if path.startswith('~'):
@@ -381,11 +704,10 @@ class RocheBitBucket(BitResolver):
 
     @staticmethod
     def _split_lines(p):
-        if ':' in p:
-            idx = p.index(':')
-            fname = os.path.basename(p[:idx])
-            return p[:idx], p[idx:].replace(':', '#').replace(',', '-')
-        return p, ''
+        head, sep, tail = p.partition(':')
+        if not sep:
+            return p, ''
+        return head, '#' + tail.replace(',', '-')
 
 
 class RocheGitLab(GitResolver):
@@ -393,7 +715,7 @@ class RocheGitLab(GitResolver):
     HOSTNAME = 'code.roche.com'
     LINE_SEP_TO = '-'
 
-    @property
+    @cached_property
     def repo_path(self):
         origin = self._repo.origin.path
         if origin.endswith('.git'):
@@ -409,7 +731,7 @@ class RocheTFS(GitResolver):
     LINE_SEP = False
     BLOB_FMT = '?path={path}&version=GB{branch}'
 
-    @property
+    @cached_property
     def repo_path(self):
         origin = self._repo.origin.path
         if origin.endswith('.git'):
@@ -421,10 +743,12 @@ class RocheTFS(GitResolver):
 
 class Kiln(Resolver):
 
-    URL_FMT = (
-        'https://{user}.kilnhg.com/Code/{repo}/{path}'
-        '?rev={branch}'
-    )
+    HIDDEN_SEGMENTS = ['bin']
+    HIDDEN_SEGMENTS_RE = re.compile(
+        r'(^|/)({})(?=/|$)'.format('|'.join(map(re.escape, HIDDEN_SEGMENTS))))
+
+    URL_FMT = 'https://{user}.kilnhg.com/Code/{repo}/'
+    PATH_FMT = '{path}?rev={branch}'
 
     @staticmethod
     def can_resolve(origin):
@@ -436,31 +760,29 @@ class Kiln(Resolver):
 
         return False
 
-    @property
+    @cached_property
     def user(self):
         return self._repo.origin.netloc.split('@', 1)[0]
 
-    @property
+    @cached_property
     def repo(self):
         return self._repo.origin.path.lstrip('/')
 
+    @cached_property
+    def _url_prefix(self):
+        return self.URL_FMT.format(user=self.user, repo=self.repo)
+
     @staticmethod
     def _split_lines(p):
-        if ':' in p:
-            idx = p.index(':')
-            return p[:idx], p[idx:].replace(':', '#').replace(',', '-')
-        return p, ''
+        head, sep, tail = p.partition(':')
+        if not sep:
+            return p, ''
+        return head, '#' + tail.replace(',', '-')
 
-    @staticmethod
-    def _rewrite_hidden_segments(p):
+    @classmethod
+    def _rewrite_hidden_segments(cls, p):
         '''Kiln uses IIS that does not allow "hidden segments".'''
-        hidden_segments = {'bin'}
-        tokens = []
-        for t in p.split('/'):
-            if t.strip() in hidden_segments:
-                t = '%24{}%24'.format(t)
-            tokens.append(t)
-        return '/'.join(tokens)
+        return cls.HIDDEN_SEGMENTS_RE.sub(r'\1%24\2%24', p)
 
     def get_path(self, what):
         if self._repo.is_commit(what):
@@ -471,32 +793,213 @@ class Kiln(Resolver):
         return self._split_lines(p)
 
     def resolve(self, what):
+        from urllib.parse import quote
         p, lines = self.get_path(what)
-        return self.URL_FMT.format(
-            user=self.user, repo=self.repo, branch=self._repo.branch,
-            path=quote(p)) + lines
+        return self._url_prefix + self.PATH_FMT.format(
+            path=quote(p), branch=self._repo.branch) + lines
+
+
+_RESOLVERS = [
+    GitHub, BitBucket,
+    Kiln, YGGitLab,
+    RocheBitBucket,
+    RocheGitLab,
+    RocheTFS,
+]
+_RESOLVERS_BY_HOST = {
+    cls.HOSTNAME: cls for cls in _RESOLVERS
+    if getattr(cls, 'HOSTNAME', None) is not None
+}
+_RESOLVERS_BY_SCHEME = {
+    'bitbucket': BitBucket,
+    'bb': BitBucket,
+    'kiln': Kiln,
+}
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'vcs-resolve')
+# URLs kept per repository, the oldest are dropped first
+CACHE_MAX_ENTRIES = 100
+# Repositories not resolved for this long are forgotten
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def _cache_token(toplevel):
+    '''Return a string that changes whenever URLs in `toplevel` may change.
+
+    Read straight from `.git`, so that checking the cache costs no
+    subprocess. Return None if the repository layout is not understood,
+    or if its configs include other files.
+    '''
+    try:
+        git_dir = _find_git_dir(toplevel)
+        common_dir = _find_common_dir(git_dir)
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        config_path = os.path.join(common_dir, 'config')
+        configs = [os.stat(config_path).st_mtime_ns]
+    except (OSError, IndexError):
+        return None
+    # Changes to included files would go unnoticed
+    if any(_has_includes(path)
+           for path in [config_path] + _global_git_configs()):
+        return None
+    # Global configs can rewrite the origin URL
+    for path in _global_git_configs():
+        try:
+            configs.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            configs.append(0)
+    commit = ''
+    if head.startswith('ref: '):
+        commit = _read_ref(common_dir, head[len('ref: '):]) or ''
+    token = '|'.join([toplevel, head, commit] + [str(c) for c in configs])
+    if '\n' in token:
+        return None
+    return token
+
+
+class URLCache:
+    '''Resolved URLs of one git repository, kept in a single file.
+
+    The whole file is thrown away as soon as the repository state it was
+    built from changes.
+    '''
+
+    def __init__(self, toplevel, token):
+        name = hashlib.sha1(toplevel.encode()).hexdigest()
+        self._path = os.path.join(CACHE_DIR, name)
+        self._token = token
+        self._urls = {}
+        self._dirty = False
+        self._used = False
+        try:
+            with open(self._path) as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return
+        if lines[0] != token:
+            return
+        for line in lines[1:]:
+            key, sep, url = line.partition('\0')
+            if sep:
+                self._urls[key] = url
+
+    @classmethod
+    def load(cls, toplevel):
+        '''Return the cache for `toplevel`, or None if it cannot be cached.'''
+        token = _cache_token(toplevel)
+        if token is None:
+            return None
+        return cls(toplevel, token)
+
+    def get(self, key):
+        url = self._urls.get(key)
+        if url is not None:
+            self._used = True
+        return url
+
+    def set(self, key, url):
+        if '\n' in key or '\0' in key or '\n' in url:
+            return
+        # Keep the most recently resolved last
+        self._urls.pop(key, None)
+        self._urls[key] = url
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            if self._used:
+                # Keep a cache that is only read from being pruned
+                try:
+                    os.utime(self._path)
+                except OSError:
+                    pass
+            return
+        entries = list(self._urls.items())[-CACHE_MAX_ENTRIES:]
+        lines = [self._token] + ['{}\0{}'.format(k, u) for k, u in entries]
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = '{}.{}'.format(self._path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(lines))
+            os.replace(tmp, self._path)
+        except OSError:
+            # The cache is only an optimization
+            return
+        self._dirty = False
+        _prune_cache()
+
+
+def _prune_cache():
+    '''Remove the caches of repositories not resolved for a while.'''
+    import time
+    cutoff = time.time() - CACHE_MAX_AGE
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
 
 
 def xdg_open(url):
-    # Discard output
-    _output = check_output(['xdg-open', url], stderr=STDOUT)
+    # Discard output and don't wait for the browser to start
+    Popen(['xdg-open', url], stdout=DEVNULL, stderr=DEVNULL,
+          start_new_session=True)
 
 
 def save_x_clipboard(stuff):
-    with tempfile.NamedTemporaryFile() as f:
-        f.write(stuff.encode())
-        f.flush()
-        check_call('xclip -selection clipboard -i {}'.format(f.name).split())
+    run(['xclip', '-selection', 'clipboard', '-i'],
+        input=stuff.encode(), check=True)
+
+
+def resolve_all(whats):
+    '''Resolve each of `whats`, sharing repo lookups between them.'''
+    repos = {}
+    # Only git repositories found on disk are cached
+    caches = {}
+    for what in whats:
+        found = _find_repo_root(_target_dir(what))
+        toplevel, kind = found
+        cache = None
+        if kind == 'git':
+            if toplevel not in caches:
+                caches[toplevel] = URLCache.load(toplevel)
+            cache = caches[toplevel]
+        key = _absolute(what)
+        url = cache.get(key) if cache is not None else None
+        if url is None:
+            candidate = Repo.get(what, found)
+            # Reuse the repo already resolved from the same place, so its
+            # cached git/hg lookups are not repeated
+            repo_key = (type(candidate), candidate._cwd)
+            repo = repos.setdefault(repo_key, candidate)
+            url = repo.resolver.resolve(candidate.what)
+            if cache is not None:
+                cache.set(key, url)
+        yield url
+    for cache in caches.values():
+        if cache is not None:
+            cache.save()
 
 
 def main():
-    what = sys.argv[1] if len(sys.argv) > 1 else '.'
-    repo = Repo.get(what)
-    url = repo.resolve()
-    xdg_open(url)
-    # TODO command arg to save to clipboard
-    # save_x_clipboard(url)
-    print(url)
+    whats = sys.argv[1:] or ['.']
+    for url in resolve_all(whats):
+        print(url)
+        # Don't open a browser tab per argument
+        if len(whats) == 1:
+            xdg_open(url)
+        # TODO command arg to save to clipboard
+        # save_x_clipboard(url)
 
 
 if __name__ == '__main__':